@@ -19,21 +19,26 @@
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+from collections import namedtuple
 from struct import pack
+import functools
+import hashlib
 import os
+import threading
 
-import six
-from six.moves import urllib
-from six.moves.urllib.parse import urljoin
+import urllib.parse
+from urllib.parse import urljoin
 
 from twisted.application.service import Service
 from twisted.internet import defer
 from twisted.internet import endpoints
+from twisted.internet import interfaces
 from twisted.plugin import getPlugins
 from twisted.logger import Logger
+from twisted.web import http
 from twisted.web import static
-from twisted.web.resource import Resource
-from twisted.web.util import Redirect
+from twisted.web.resource import EncodingResourceWrapper, Resource
+from twisted.web.server import GzipEncoderFactory
 
 import txws
 
@@ -53,7 +58,7 @@ from shinysdr.values import SubscriptionContext
 
 # txWS is unfortunately dead upstream, and has buggy Python 3 support.
 # On Python 3, upstream txWS can't properly encode frames larger than
-# 0x7d bytes. Monkey-patch the function here with a 2+3 compatible
+# 0x7d bytes. Monkey-patch the function here with a working
 # implementation.
 def make_hybi07_frame(buf, opcode=0x1):
     """
@@ -68,26 +73,224 @@ def make_hybi07_frame(buf, opcode=0x1):
     elif len(buf) > 0x7d:
         length = b"\x7e%s" % pack(">H", len(buf))
     else:
-        length = six.int2byte(len(buf))
+        length = bytes((len(buf),))
 
-    if isinstance(buf, six.text_type):
+    if isinstance(buf, str):
         buf = buf.encode('utf-8')
 
     # Always make a normal packet.
-    header = six.int2byte(0x80 | opcode)
+    header = bytes((0x80 | opcode,))
     return header + length + buf
 
 
 txws.make_hybi07_frame = make_hybi07_frame
 
 
+# Size of each os.sendfile() call made by SendfileStaticProducer.
+_SENDFILE_CHUNK_SIZE = 1 << 20
+
+# File extensions worth gzipping; compressing already-compressed media just wastes CPU.
+_COMPRESSIBLE_EXTENSIONS = frozenset(['.css', '.csv', '.html', '.js', '.json', '.map', '.svg', '.txt'])
+_gzip_encoder_factories = [GzipEncoderFactory()]
+
+
+def _transport_sendfile_fd(request):
+    """Return the raw socket file descriptor for the request's transport, or None if writing to it directly would be incorrect (TLS, response encoders, non-socket transports, no OS support)."""
+    if not hasattr(os, 'sendfile'):
+        return None
+    if getattr(request, '_encoder', None) is not None:
+        # Something (e.g. gzip) is transforming the body; bytes must go through request.write.
+        return None
+    transport = request.transport
+    if interfaces.ISSLTransport.providedBy(transport):
+        return None
+    get_handle = getattr(transport, 'getHandle', None)
+    if get_handle is None or not hasattr(transport, 'dataBuffer'):
+        # Need visibility into the userland write buffer to avoid reordering; see SendfileStaticProducer.
+        return None
+    try:
+        return get_handle().fileno()
+    except (AttributeError, OSError):
+        return None
+
+
+def _discard_encoder(request):
+    """Disarm any content encoder on the request so that no more encoded bytes are emitted.
+
+    Request.finish flushes request._encoder even when the response code forbids a body, which
+    would put the gzip stream tail on the wire after a 304's headers and desync keep-alive
+    framing; call this before returning an empty body for a CACHED conditional-request result.
+    """
+    if getattr(request, '_encoder', None) is not None:
+        request._encoder = None
+        request.responseHeaders.removeHeader(b'content-encoding')
+
+
+class SendfileStaticProducer(static.StaticProducer):
+    """Producer which transfers a whole file with os.sendfile(), avoiding copying the contents through userland.
+
+    Only usable when the transport is a plain (non-TLS) socket; see SendfileStaticFile.makeProducer.
+    """
+
+    def __init__(self, request, fileObject, size):
+        static.StaticProducer.__init__(self, request, fileObject)
+        self.__offset = 0
+        self.__size = size
+        self.__headers_written = False
+
+    def start(self):
+        self.request.registerProducer(self, False)
+
+    def resumeProducing(self):
+        request = self.request
+        if not request:
+            return
+        if not self.__headers_written:
+            # Flush the response headers through the normal path before writing to the socket directly.
+            self.__headers_written = True
+            request.write(b'')
+            return
+        transport = request.transport
+        fd = _transport_sendfile_fd(request)
+        if fd is not None and not (transport.dataBuffer or transport._tempDataLen):
+            try:
+                sent = os.sendfile(
+                    fd,
+                    self.fileObject.fileno(),
+                    self.__offset,
+                    min(self.__size - self.__offset, _SENDFILE_CHUNK_SIZE))
+            except (BlockingIOError, InterruptedError):
+                # Kernel socket buffer is full; fall through to the buffered path.
+                pass
+            except OSError:
+                request.unregisterProducer()
+                self.stopProducing()
+                return
+            else:
+                self.__offset += sent
+                if sent == 0 or self.__offset >= self.__size:
+                    self.__finish_transfer()
+                return
+        # Either bytes are queued in userland which sendfile() must not overtake (the headers,
+        # or earlier chunks written here), or the socket would block, or the fd became unusable.
+        # In all of those cases, write through request.write like stock NoRangeStaticProducer.
+        # This is what keeps a stalled client from busy-polling this producer: the cooperator
+        # driving it re-invokes resumeProducing every reactor tick, and only the transport
+        # buffer growing past its high-water mark engages the backpressure that pauses it.
+        self.fileObject.seek(self.__offset)
+        data = self.fileObject.read(self.bufferSize)
+        if not data:
+            self.__finish_transfer()
+            return
+        self.__offset += len(data)
+        request.write(data)
+        if self.__offset >= self.__size:
+            self.__finish_transfer()
+
+    def __finish_transfer(self):
+        request = self.request
+        request.unregisterProducer()
+        request.finish()
+        self.stopProducing()
+
+
+class SendfileStaticFile(static.File):
+    """static.File which serves plain whole-file GETs over non-TLS transports using os.sendfile()."""
+
+    def render_GET(self, request):
+        """overrides static.File"""
+        ret = static.File.render_GET(self, request)
+        if request.code == http.NOT_MODIFIED:
+            # The If-Modified-Since check inside static.File.render_GET hit.
+            _discard_encoder(request)
+        return ret
+
+    def makeProducer(self, request, fileForReading):
+        """overrides static.File"""
+        producer = static.File.makeProducer(self, request, fileForReading)
+        if type(producer) is static.NoRangeStaticProducer \
+                and _transport_sendfile_fd(request) is not None:
+            try:
+                fileForReading.fileno()
+            except (AttributeError, OSError):
+                # Not a real file (e.g. compressed content wrapped in another object).
+                return producer
+            return SendfileStaticProducer(request, fileForReading, self.getFileSize())
+        return producer
+
+    def getChild(self, path, request):
+        """overrides static.File, to serve compressible children gzipped when the client accepts that"""
+        child = static.File.getChild(self, path, request)
+        if isinstance(child, static.File) \
+                and os.path.splitext(child.path)[1].lower() in _COMPRESSIBLE_EXTENSIONS:
+            return EncodingResourceWrapper(child, _gzip_encoder_factories)
+        return child
+
+
+# Files at most this size are served out of _small_file_cache rather than reopened per request.
+_SMALL_FILE_CACHE_LIMIT = 64 * 1024
+
+_SmallFileCacheEntry = namedtuple('_SmallFileCacheEntry', ['data', 'mtime', 'size', 'etag'])
+
+# {path: _SmallFileCacheEntry}; keyed by path because static.File children are new instances per lookup.
+_small_file_cache = {}
+
+
+class CachedStaticFile(SendfileStaticFile):
+    """SendfileStaticFile which additionally serves small files from an in-process cache, invalidated by mtime/size."""
+
+    def render_GET(self, request):
+        """overrides static.File"""
+        self.restat(False)
+        if self.isdir() or not self.exists() or self.islink():
+            return SendfileStaticFile.render_GET(self, request)
+        st = os.stat(self.path)
+        if st.st_size > _SMALL_FILE_CACHE_LIMIT or request.getHeader(b'range') is not None:
+            return SendfileStaticFile.render_GET(self, request)
+        entry = _small_file_cache.get(self.path)
+        if entry is None or entry.mtime != st.st_mtime or entry.size != st.st_size:
+            try:
+                with open(self.path, 'rb') as f:
+                    data = f.read()
+            except EnvironmentError:
+                return SendfileStaticFile.render_GET(self, request)
+            entry = _SmallFileCacheEntry(
+                data=data,
+                mtime=st.st_mtime,
+                size=st.st_size,
+                etag=b'"%x-%x"' % (int(st.st_mtime), st.st_size))
+            _small_file_cache[self.path] = entry
+        content_type, content_encoding = static.getTypeAndEncoding(
+            self.basename(), self.contentTypes, self.contentEncodings, self.defaultType)
+        if content_type:
+            request.setHeader(b'Content-Type', content_type.encode('utf-8'))
+        if content_encoding:
+            request.setHeader(b'Content-Encoding', content_encoding.encode('utf-8'))
+        request.setHeader(b'Accept-Ranges', b'bytes')
+        if request.setLastModified(st.st_mtime) == http.CACHED:
+            _discard_encoder(request)
+            return b''
+        etag = entry.etag
+        if getattr(request, '_encoder', None) is not None:
+            # The on-the-wire representation differs from the cached one.
+            etag = etag[:-1] + b'-enc"'
+        if request.setETag(etag) == http.CACHED:
+            _discard_encoder(request)
+            return b''
+        request.setHeader(b'Content-Length', b'%d' % entry.size)
+        return entry.data
+
+
 def _make_static_resource(pathname):
-    # str() because if we happen to pass unicode as the pathname then directory listings break (discovered with Twisted 16.4.1).
-    r = static.File(str(pathname),
+    # pathname must be a plain str; unicode pathnames broke directory listings (discovered with Twisted 16.4.1).
+    r = CachedStaticFile(pathname,
         defaultType='text/plain',
         ignoredExts=['.html'])
     r.contentTypes['.csv'] = 'text/csv'
     r.indexNames = ['index.html']
+    if os.path.splitext(r.path)[1].lower() in _COMPRESSIBLE_EXTENSIONS:
+        # This resource is itself a single compressible file rather than a directory.
+        return EncodingResourceWrapper(r, _gzip_encoder_factories)
     return r
 
 
@@ -127,7 +330,7 @@ class WebService(Service):
         
         if UNIQUE_PUBLIC_CAP in cap_table:
             # TODO: consider factoring out "generate URL for cap"
-            server_root.putChild(b'', Redirect(_make_cap_url(UNIQUE_PUBLIC_CAP)))
+            server_root.putChild(b'', HeaderOnlyRedirect(_make_cap_url(UNIQUE_PUBLIC_CAP)))
             
         self.__ws_protocol = txws.WebSocketFactory(
             FactoryWithArgs.forProtocol(WebSocketDispatcherProtocol, cap_table, subscription_context))
@@ -145,13 +348,20 @@ class WebService(Service):
         self.__ws_port_obj = yield self.__ws_endpoint.listen(self.__ws_protocol)
     
     def stopService(self):
-        Service.stopService(self)
         if self.__ws_port_obj is None:
             raise Exception('Not started, cannot stop')
-        # TODO: Does Twisted already have something to bundle up a bunch of ports for shutdown?
-        return defer.DeferredList([
+        # consumeErrors so a failure of one port's shutdown is not separately logged as unhandled.
+        d = defer.gatherResults([
             self.__http_port_obj.stopListening(),
-            self.__ws_port_obj.stopListening()])
+            self.__ws_port_obj.stopListening()],
+            consumeErrors=True)
+
+        def mark_stopped(result):
+            # Don't report ourselves stopped until the ports' shutdown has settled, whether or not it succeeded.
+            Service.stopService(self)
+            return result
+
+        return d.addBoth(mark_stopped)
     
     def get_host_relative_url(self):
         """Get the host-relative URL of the service.
@@ -186,62 +396,80 @@ class WebService(Service):
 
 def _put_root_static(wcommon, container_resource):
     """Place all the simple resources, that are not necessarily sourced from files but at least are unchanging and public."""
-    
+    join = os.path.join
+
     for name in ['', 'client', 'test', 'manual', 'tools']:
-        container_resource.putChild(name.encode(), _make_static_resource(os.path.join(static_resource_path, name if name != '' else 'index.html')))
-    
+        container_resource.putChild(name.encode(), _make_static_resource(join(static_resource_path, name if name != '' else 'index.html')))
+
     # Link deps into /client/.
     client = container_resource.children[b'client']
     for name in ['require.js', 'text.js']:
-        client.putChild(name.encode(), _make_static_resource(os.path.join(deps_path, name)))
+        client.putChild(name.encode(), _make_static_resource(join(deps_path, name)))
     for name in ['measviz.js', 'measviz.css']:
-        client.putChild(name.encode(), _make_static_resource(os.path.join(deps_path, 'measviz/src', name)))
-    
+        client.putChild(name.encode(), _make_static_resource(join(deps_path, 'measviz/src', name)))
+
     # Link deps into /test/.
     test = container_resource.children[b'test']
     jasmine = SlashedResource()
     test.putChild(b'jasmine', jasmine)
     for name in ['jasmine.css', 'jasmine.js', 'jasmine-html.js']:
-        jasmine.putChild(name.encode(), _make_static_resource(os.path.join(
+        jasmine.putChild(name.encode(), _make_static_resource(join(
             deps_path, 'jasmine/lib/jasmine-core/', name)))
-    
+
     # Special resources
     container_resource.putChild(b'favicon.ico',
-        _make_static_resource(os.path.join(static_resource_path, 'client/icon/icon-32.png')))
+        _make_static_resource(join(static_resource_path, 'client/icon/icon-32.png')))
     client.putChild(b'web-app-manifest.json',
         WebAppManifestResource(wcommon))
     _put_plugin_resources(wcommon, client)
 
 
+_plugins_snapshot_cache = None
+_plugins_snapshot_lock = threading.Lock()
+
+
+def _plugins_snapshot():
+    """Scan the plugins and modes once; the plugin set is fixed for the life of the process, so every WebService instance can share the result."""
+    global _plugins_snapshot_cache
+    with _plugins_snapshot_lock:
+        if _plugins_snapshot_cache is None:
+            load_list_css = []
+            load_list_js = []
+            mode_table = {}
+            plugin_children = {}
+            for resource_def in getPlugins(_IClientResourceDef, shinysdr.plugins):
+                # Add the plugin's resource to static serving
+                plugin_children[resource_def.key.encode('utf-8')] = resource_def.resource
+                plugin_resource_url = '/client/plugins/' + urllib.parse.quote(resource_def.key, safe='') + '/'
+                # Tell the client to load the plugins
+                # TODO constrain path values to be relative (not on a different origin, to not leak urls)
+                if resource_def.load_css_path is not None:
+                    load_list_css.append(plugin_resource_url + resource_def.load_cs_path)
+                if resource_def.load_js_path is not None:
+                    # TODO constrain value to be in the directory
+                    load_list_js.append(plugin_resource_url + resource_def.load_js_path)
+            for mode_def in get_modes():
+                mode_table[mode_def.mode] = {
+                    u'info_enum_row': mode_def.info.to_json(),
+                    u'can_transmit': mode_def.mod_class is not None
+                }
+
+            plugin_index = {
+                'css': load_list_css,
+                'js': load_list_js,
+                'modes': mode_table,
+            }
+            _plugins_snapshot_cache = (plugin_children, plugin_index)
+        return _plugins_snapshot_cache
+
+
 def _put_plugin_resources(wcommon, client_resource):
     """Plugin-defined resources and client-configuration."""
-    load_list_css = []
-    load_list_js = []
-    mode_table = {}
+    plugin_children, plugin_index = _plugins_snapshot()
     plugin_resources = Resource()
     client_resource.putChild(b'plugins', plugin_resources)
-    for resource_def in getPlugins(_IClientResourceDef, shinysdr.plugins):
-        # Add the plugin's resource to static serving
-        plugin_resources.putChild(resource_def.key.encode('utf-8'), resource_def.resource)
-        plugin_resource_url = '/client/plugins/' + urllib.parse.quote(resource_def.key, safe='') + '/'
-        # Tell the client to load the plugins
-        # TODO constrain path values to be relative (not on a different origin, to not leak urls)
-        if resource_def.load_css_path is not None:
-            load_list_css.append(plugin_resource_url + resource_def.load_cs_path)
-        if resource_def.load_js_path is not None:
-            # TODO constrain value to be in the directory
-            load_list_js.append(plugin_resource_url + resource_def.load_js_path)
-    for mode_def in get_modes():
-        mode_table[mode_def.mode] = {
-            u'info_enum_row': mode_def.info.to_json(),
-            u'can_transmit': mode_def.mod_class is not None
-        }
-    
-    plugin_index = {
-        'css': load_list_css,
-        'js': load_list_js,
-        'modes': mode_table,
-    }
+    for key, plugin_resource in plugin_children.items():
+        plugin_resources.putChild(key, plugin_resource)
     client_resource.putChild(b'client-configuration.json', ClientConfigurationResource(wcommon, plugin_index))
 
 
@@ -259,10 +487,14 @@ class ClientConfigurationResource(Resource):
         configuration = {
             'plugins': self.__plugin_index,
             # TODO: oughta be a shorter path to this -- normally websocket url is constructed from a http url gotten from the request so we don't have this exact path
-            'shared_test_objects_url': self.__wcommon.make_websocket_url(request, 
+            'shared_test_objects_url': self.__wcommon.make_websocket_url(request,
                 _make_cap_url(SHARED_TEST_OBJECTS_CAP) + CAP_OBJECT_PATH_ELEMENT),
         }
-        return serialize(configuration).encode('utf-8')
+        body = serialize(configuration).encode('utf-8')
+        # The body varies with the requested host, so the ETag is computed per request; it still lets clients revisit with a 304 instead of re-downloading.
+        if request.setETag(_body_etag(body)) == http.CACHED:
+            return b''
+        return body
 
 
 class WebAppManifestResource(Resource):
@@ -274,14 +506,11 @@ class WebAppManifestResource(Resource):
     
     def __init__(self, wcommon):
         Resource.__init__(self)
-        self.__title = wcommon.title
-
-    def render_GET(self, request):
-        request.setHeader(b'Content-Type', b'application/manifest+json')
+        title = wcommon.title
         manifest = {
             'lang': 'en-US',
-            'name': self.__title,
-            'short_name': self.__title if len(self.__title) <= 12 else 'ShinySDR',
+            'name': title,
+            'short_name': title if len(title) <= 12 else 'ShinySDR',
             'scope': '/',
             'icons': [
                 {
@@ -300,9 +529,42 @@ class WebAppManifestResource(Resource):
             'theme_color': '#B9B9B9',  # same as gray.css --shinysdr-theme-column-bgcolor
             'background_color': '#2F2F2F',  # note this is our loading screen color
         }
-        return serialize(manifest).encode('utf-8')
+        # The manifest depends only on the (fixed) title, so serialize it once rather than per request.
+        self.__body = serialize(manifest).encode('utf-8')
+        self.__length = str(len(self.__body)).encode('ascii')
+        self.__etag = _body_etag(self.__body)
+
+    def render_GET(self, request):
+        request.setHeader(b'Content-Type', b'application/manifest+json')
+        if request.setETag(self.__etag) == http.CACHED:
+            return b''
+        request.setHeader(b'Content-Length', self.__length)
+        return self.__body
+
+
+class HeaderOnlyRedirect(Resource):
+    """Like twisted.web.util.Redirect, but sends only status and Location, not a formatted HTML body."""
+
+    isLeaf = True
+
+    def __init__(self, location):
+        Resource.__init__(self)
+        self.__location = location.encode('ascii')
+
+    def render(self, request):
+        request.setResponseCode(http.FOUND)
+        request.setHeader(b'Location', self.__location)
+        request.setHeader(b'Content-Length', b'0')
+        return b''
+
+
+def _body_etag(body):
+    """Strong ETag for an entity body, so unchanged JSON resources can answer conditional requests with 304."""
+    return b'"' + hashlib.sha1(body).hexdigest().encode('ascii') + b'"'
 
 
+@functools.lru_cache(maxsize=1024)
 def _make_cap_url(cap):
-    assert isinstance(cap, six.text_type)
+    # Caps are immutable strings and few in number, so quoting each one once is enough.
+    assert isinstance(cap, str)
     return defaultstr('/' + urllib.parse.quote(cap.encode('utf-8'), safe='') + '/')
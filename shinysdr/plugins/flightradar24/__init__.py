@@ -22,15 +22,18 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 from collections import namedtuple
-import json
+from operator import itemgetter
 import os.path
 
-import six
+try:
+    # orjson parses the large feed bodies severalfold faster; fall back to the stdlib if it is not installed.
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
 
 from twisted.internet import task
-from twisted.python.url import URL
 from twisted.web import static
-from twisted.web.client import Agent, readBody
+from twisted.web.client import Agent, HTTPConnectionPool, readBody
 from zope.interface import Interface, implementer
 
 from shinysdr.devices import Device, IComponent
@@ -51,6 +54,7 @@ _INCH_PER_FOOT = 12
 _METERS_PER_FEET = (_CM_PER_INCH * _INCH_PER_FOOT) / 100
 _FEET_PER_MINUTE_TO_METERS_PER_SECOND = _METERS_PER_FEET * 60
 _BASE_URL = 'https://data-live.flightradar24.com/zones/fcgi/feed.js?faa=1&mlat=1&flarm=1&adsb=1&gnd=0&air=1&vehicles=0&estimated=1&maxage=14400&gliders=1&stats=0'
+_GET = b'GET'
 
 
 def Flightradar24(reactor, key='flightradar24', bounds=None, base_url=_BASE_URL):
@@ -60,7 +64,7 @@ def Flightradar24(reactor, key='flightradar24', bounds=None, base_url=_BASE_URL)
     bounds: optional 4-element tuple of (lat1, lat2, lon1, lon2) to restrict search
     base_url: optional URL to override the source of the data feed
     """
-    return Device(components={six.text_type(key): _Flightradar24Client(
+    return Device(components={str(key): _Flightradar24Client(
         reactor=reactor,
         bounds=bounds,
         base_url=base_url)})
@@ -70,54 +74,73 @@ def Flightradar24(reactor, key='flightradar24', bounds=None, base_url=_BASE_URL)
 class _Flightradar24Client(ExportedState):
     def __init__(self, reactor, bounds, base_url=_BASE_URL):
         self.__reactor = reactor
-        self.__agent = Agent(reactor)
-        self.__bounds = bounds
+        # Keep the TCP/TLS connection to the feed server warm between polls rather than paying for a fresh handshake every time.
+        self.__pool = HTTPConnectionPool(reactor, persistent=True)
+        self.__pool.maxPersistentPerHost = 1
+        self.__agent = Agent(reactor, pool=self.__pool)
         self.__device_contexts = []
+        self.__enabled = False
         self.__loop = None
-        self.__url = URL.fromText(base_url)
+        # The URL never changes after construction, so build the byte string once rather than in the polling loop.
+        url_bytes = base_url.encode('ascii')
+        if bounds:
+            # Bounds are numeric, so they need no quoting and can be formatted straight to bytes.
+            bounds_bytes = b','.join(b'%g' % b for b in bounds)
+            url_bytes += (b'&' if b'?' in url_bytes else b'?') + b'bounds=' + bounds_bytes
+        self.__url_bytes = url_bytes
 
     @exported_value(type=bool, changes='this_setter', label='Enabled')
     def get_enabled(self):
-        return self.__loop is not None
+        return self.__enabled
 
     @setter
     def set_enabled(self, enabled):
-        if enabled and not self.__loop:
-            self.__loop = task.LoopingCall(self.__send_request)
-            self.__loop.clock = self.__reactor
-            self.__loop.start(_POLLING_INTERVAL).addErrback(print)
-        elif not enabled and self.__loop:
-            self.__loop.stop()
-            self.__loop = None
+        self.__enabled = bool(enabled)
+        self.__update_loop()
 
     def close(self):
-        if self.__loop:
-            self.__loop.stop()
-            self.__loop = None
+        self.__enabled = False
+        self.__update_loop()
+        self.__pool.closeCachedConnections()
 
     def attach_context(self, device_context):
         """implements IComponent"""
         self.__device_contexts.append(device_context)
+        self.__update_loop()
+
+    def detach_context(self, device_context):
+        """Reverse of attach_context; polling stops while no contexts remain attached."""
+        self.__device_contexts.remove(device_context)
+        self.__update_loop()
 
-    def __make_url(self):
-        u = self.__url
-        if self.__bounds:
-            u = u.set('bounds', ','.join(str(b) for b in self.__bounds))
-        return six.binary_type(u.asText())
+    def __update_loop(self):
+        """Run the polling loop only while it is enabled and somebody is listening."""
+        want_loop = self.__enabled and bool(self.__device_contexts)
+        if want_loop and not self.__loop:
+            self.__loop = task.LoopingCall(self.__send_request)
+            self.__loop.clock = self.__reactor
+            # now=False so that many clients enabling at once do not stampede the feed server.
+            self.__loop.start(_POLLING_INTERVAL, now=False).addErrback(print)
+        elif not want_loop and self.__loop:
+            self.__loop.stop()
+            self.__loop = None
 
     def __send_request(self):
         if not self.__device_contexts:
             return
-        d = self.__agent.request(six.binary_type('GET'), self.__make_url())
+        d = self.__agent.request(_GET, self.__url_bytes)
         d.addCallback(readBody)
         
         def process(body):
-            data = json.loads(body)
-            for object_id, aircraft in six.iteritems(data):
+            data = _json_loads(body)
+            contexts = self.__device_contexts
+            for object_id, aircraft in data.items():
                 if not isinstance(aircraft, list):
                     continue
-                for c in self.__device_contexts:
-                    c.output_message(AircraftWrapper(object_id, aircraft))
+                # One wrapper per aircraft, shared by all contexts.
+                message = AircraftWrapper(object_id, aircraft)
+                for c in contexts:
+                    c.output_message(message)
         d.addCallback(process)
         d.addErrback(print)
 
@@ -163,6 +186,36 @@ empty_flight_info = FlightInfo(
 )
 
 
+# Track-related feed fields, unpacked in one C-level call rather than one subscript each.
+_TRACK_GETTER = itemgetter(
+    10,  # timestamp
+    1,  # latitude
+    2,  # longitude
+    3,  # bearing, in degrees
+    4,  # altitude, in feet
+    5,  # speed, in knots
+    15,  # rate of climb, in ft/min
+)
+
+# (Track key, scale to SI) for the last three _TRACK_GETTER fields, in order.
+_TRACK_SCALED_FIELDS = (
+    ('altitude', _METERS_PER_FEET),
+    ('h_speed', _KNOTS_TO_METERS_PER_SECOND),
+    ('v_speed', _FEET_PER_MINUTE_TO_METERS_PER_SECOND),
+)
+
+# Feed indexes of the FlightInfo fields, in namedtuple field order.
+_FLIGHT_INFO_GETTER = itemgetter(
+    16,  # callsign
+    9,  # registration
+    11,  # origin
+    12,  # destination
+    13,  # flight
+    6,  # squawk_code
+    8,  # model
+)
+
+
 @implementer(IAircraft, ITelemetryObject)
 class Aircraft(ExportedState):
     def __init__(self, object_id):
@@ -176,24 +229,7 @@ class Aircraft(ExportedState):
         d = message_wrapper.message
         # Fields from https://github.com/derhuerst/flightradar24-client/blob/master/lib/radar.js
  
-        timestamp = d[10]
-
-        # Part of self.__track
-        latitude = d[1]
-        longitude = d[2]
-        altitude = d[4]  # in feet
-        bearing = d[3]  # in degrees
-        speed = d[5]  # in knots
-        rate_of_climb = d[15]  # ft/min
-
-        # Shown separately
-        callsign = d[16]  # ICAO ATC call signature
-        registration = d[9]
-        origin = d[11]  # airport IATA code
-        destination = d[12]  # airport IATA code
-        flight = d[13]
-        squawk_code = d[6]  # https://en.wikipedia.org/wiki/Transponder_(aeronautics)
-        model = d[8]  # ICAO aircraft type designator
+        timestamp, latitude, longitude, bearing, altitude, speed, rate_of_climb = _TRACK_GETTER(d)
 
         # Unused
         #is_on_ground = bool(d[14])
@@ -207,30 +243,19 @@ class Aircraft(ExportedState):
                 latitude=TelemetryItem(latitude, timestamp),
                 longitude=TelemetryItem(longitude, timestamp),
             )
-        if altitude:
-            new.update(altitude=TelemetryItem(altitude * _METERS_PER_FEET, timestamp))
-        if speed:
-            new.update(h_speed=TelemetryItem(speed * _KNOTS_TO_METERS_PER_SECOND, timestamp))
         if bearing:
             new.update(
                 heading=TelemetryItem(bearing, timestamp),
                 track_angle=TelemetryItem(bearing, timestamp),
             )
-        if rate_of_climb:
-            new.update(v_speed=TelemetryItem(rate_of_climb * _FEET_PER_MINUTE_TO_METERS_PER_SECOND, timestamp))
+        for (key, scale), value in zip(_TRACK_SCALED_FIELDS, (altitude, speed, rate_of_climb)):
+            if value:
+                new[key] = TelemetryItem(value * scale, timestamp)
         if new:
             self.__track = self.__track._replace(**new)
-        
+
         self.__last_heard_time = timestamp
-        self.__flight_info = FlightInfo(
-            callsign=callsign,
-            registration=registration,
-            origin=origin,
-            destination=destination,
-            flight=flight,
-            squawk_code=squawk_code,
-            model=model,
-        )
+        self.__flight_info = FlightInfo._make(_FLIGHT_INFO_GETTER(d))
         self.state_changed()
     
     def is_interesting(self):